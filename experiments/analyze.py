@@ -1,19 +1,24 @@
 """Run CNN ablation experiments."""
 import argparse
 import csv
+import json
 import pathlib
 import shutil
+from typing import Dict, FrozenSet, Sequence, Tuple
 
 from src import exemplars, milan, milannotations
 from src.utils import ablations, env, training, viz
-from src.utils.typing import StrSequence
+from src.utils.typing import StrSequence, Unit
 
 import numpy as np
 import spacy
 import torch
 import wandb
+from spacy.attrs import HEAD, POS
+from spacy.symbols import ADJ, ADP, NOUN, VERB
+from spacy.tokens import Doc, DocBin
 from torch import cuda
-from tqdm import tqdm
+from torch.utils import data
 
 EXPERIMENT_RANDOM = 'random'
 
@@ -77,13 +82,137 @@ GROUPS_BY_EXPERIMENT = {
     for experiment in EXPERIMENTS_BY_GROUP[group]
 }
 
+POS_BY_EXPERIMENT = {
+    EXPERIMENT_N_NOUNS: NOUN,
+    EXPERIMENT_N_VERBS: VERB,
+    EXPERIMENT_N_ADPS: ADP,
+    EXPERIMENT_N_ADJS: ADJ,
+}
+
 ORDER_INCREASING = 'increasing'
 ORDER_DECREASING = 'decreasing'
 ORDERS = (ORDER_DECREASING, ORDER_INCREASING)
 
+FEATURE_VECTORS = 'vectors'
+FEATURE_VECTORLESS = 'vectorless'
+
 CNNS = (exemplars.models.KEYS.RESNET18,)
 DATASETS = (exemplars.datasets.KEYS.IMAGENET,)
 
+
+def parse_depth(tokens: Doc) -> int:
+    """Return the depth of the parse tree under the last root in the doc.
+
+    Rather than searching the tree token by token, every token walks up its
+    head array in lockstep, so this loops once per level of the tree.
+
+    Args:
+        tokens (Doc): The parsed description.
+
+    Returns:
+        int: Number of edges on the longest path down from the root, or 0 if
+            the doc is empty.
+
+    """
+    if not len(tokens):
+        return 0
+
+    # Heads are stored as unsigned offsets; roots are their own heads.
+    nodes = np.arange(len(tokens))
+    parents = nodes + tokens.to_array(HEAD).astype(np.int64)
+    roots = nodes[parents == nodes]
+    assert len(roots), 'no root?'
+
+    depths = np.zeros_like(nodes)
+    ancestors = nodes
+    while True:
+        above = parents[ancestors]
+        moving = above != ancestors
+        if not moving.any():
+            break
+        depths += moving
+        ancestors = above
+
+    return int(depths[ancestors == roots[-1]].max())
+
+
+def precompute_features(tokenized: Sequence[Doc]) -> Dict[str, np.ndarray]:
+    """Compute every description feature the experiments score units by.
+
+    All features come from a single pass over the descriptions. Syntactic
+    and structural features are keyed by the name of the experiment that
+    uses them, so those experiments just look up their scores.
+
+    Args:
+        tokenized (Sequence[Doc]): The parsed descriptions.
+
+    Returns:
+        Dict[str, np.ndarray]: Mapping from experiment name to a score for
+            every description, plus the unit-normalized description vectors
+            of shape (len(tokenized), vector_size) under `FEATURE_VECTORS`
+            and a boolean mask of the descriptions with no vector under
+            `FEATURE_VECTORLESS`.
+
+    """
+    pos_ids = np.array(list(POS_BY_EXPERIMENT.values()), dtype=np.int64)
+    counts = np.zeros((len(pos_ids), len(tokenized)), dtype=np.int64)
+    lengths = np.zeros(len(tokenized), dtype=np.int64)
+    depths = np.zeros(len(tokenized), dtype=np.int64)
+    differences = np.zeros(len(tokenized), dtype=np.float32)
+    vectors: np.ndarray = np.stack(
+        [np.asarray(tokens.vector, dtype=np.float32) for tokens in tokenized])
+    for index, tokens in enumerate(tokenized):
+        tags = tokens.to_array(POS).astype(np.int64)
+        counts[:, index] = np.equal.outer(pos_ids, tags).sum(axis=-1)
+        lengths[index] = len(tokens)
+        depths[index] = parse_depth(tokens)
+
+        # Empty descriptions have no words to compare, so leave them at 0.
+        if not len(tokens):
+            continue
+
+        # Expand |u - v|^2 = |u|^2 + |v|^2 - 2u.v so that all pairwise
+        # distances come from a single matmul.
+        words: np.ndarray = np.stack(
+            [np.asarray(token.vector, dtype=np.float32) for token in tokens])
+        norms = np.einsum('ij,ij->i', words, words)
+        distances = norms[:, None] + norms[None, :] - 2 * words @ words.T
+        differences[index] = distances.max()
+
+    # Unit-normalize description vectors once, so cosine similarity to any
+    # target is a single matrix-vector product. Descriptions made only of
+    # out-of-vocabulary words have no vector, so they have no similarity to
+    # anything either.
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    vectors /= np.where(norms == 0, 1, norms)
+
+    features: Dict[str, np.ndarray] = dict(zip(POS_BY_EXPERIMENT, counts))
+    features[EXPERIMENT_DESCRIPTION_LENGTH] = lengths
+    features[EXPERIMENT_PARSE_DEPTH] = depths
+    features[EXPERIMENT_MAX_WORD_DIFFERENCE] = differences
+    features[FEATURE_VECTORS] = vectors
+    features[FEATURE_VECTORLESS] = norms.squeeze(-1) == 0
+    return features
+
+
+def class_accuracies(evaluation: ablations.ClassifierEvaluation,
+                     classes: StrSequence) -> Dict[str, float]:
+    """Return the class-by-class breakdown of accuracy for logging.
+
+    Args:
+        evaluation (ablations.ClassifierEvaluation): The test results.
+        classes (StrSequence): Class names, indexed by class label.
+
+    Returns:
+        Dict[str, float]: Mapping from `accuracy-<class name>` to accuracy.
+
+    """
+    return {
+        f'accuracy-{classes[cat]}': acc
+        for cat, acc in evaluation.accuracies.items()
+    }
+
+
 parser = argparse.ArgumentParser(description='run cnn ablation experiments')
 parser.add_argument('--cnns',
                     nargs='+',
@@ -142,6 +271,32 @@ parser.add_argument(
     default=5,
     help='for each experiment, delete an equal number of random '
     'neurons and retest this many times (default: 5)')
+parser.add_argument('--nlp-batch-size',
+                    type=int,
+                    default=256,
+                    help='descriptions to parse at once (default: 256)')
+parser.add_argument('--nlp-n-process',
+                    type=int,
+                    default=1,
+                    help='processes to use for parsing descriptions '
+                    '(default: 1)')
+parser.add_argument('--compile-forward',
+                    action='store_true',
+                    help='if set, torch.compile the cnn when testing '
+                    '(default: do not)')
+parser.add_argument('--amp',
+                    action='store_true',
+                    help='if set, test the cnn under autocast '
+                    '(default: do not)')
+parser.add_argument('--batch-size',
+                    type=int,
+                    default=128,
+                    help='batch size for testing the cnn (default: 128)')
+parser.add_argument('--num-workers',
+                    type=int,
+                    default=0,
+                    help='data loader workers for testing the cnn '
+                    '(default: 0)')
 parser.add_argument('--device', help='manually set device (default: guessed)')
 parser.add_argument('--wandb-project',
                     default='milan',
@@ -186,11 +341,29 @@ if args.groups:
     for group in args.groups:
         experiments |= EXPERIMENTS_BY_GROUP[group]
 
-nlp = spacy.load('en_core_web_lg')
+# No experiment needs entities or lemmas, so skip those components entirely.
+nlp = spacy.load('en_core_web_lg', exclude=('ner', 'lemmatizer'))
+
+# Semantic targets are single words, so only their vectors matter. Look them
+# all up in one pass up front, without running any pipeline components.
+targets = sorted(experiments & EXPERIMENTS_BY_GROUP[GROUP_SEMANTIC])
+target_vectors: Dict[str, np.ndarray] = {}
+for target, tokens in zip(targets, nlp.pipe(targets, disable=nlp.pipe_names)):
+    vector = tokens.vector
+    target_vectors[target] = vector / (np.linalg.norm(vector) or 1)
+
 for dataset_name in args.datasets:
     dataset = exemplars.datasets.load(dataset_name,
                                       factory=training.PreloadedImageFolder)
     assert isinstance(dataset, training.PreloadedImageFolder)
+
+    # Every ablation is tested on the full dataset, so build one loader for
+    # all of them instead of respawning its workers for every test.
+    loader = data.DataLoader(dataset,
+                             batch_size=args.batch_size,
+                             num_workers=args.num_workers,
+                             pin_memory=torch.device(device).type == 'cuda',
+                             persistent_workers=args.num_workers > 0)
     for cnn_name in args.cnns:
         model_results_dir = results_dir / cnn_name / dataset_name
         model_results_dir.mkdir(exist_ok=True, parents=True)
@@ -236,11 +409,66 @@ for dataset_name in args.datasets:
         # Always save the current descriptions used by this script.
         wandb.save(str(descriptions_file))
 
-        # Pretokenize the descriptions for efficiency.
-        tokenized = tuple(nlp.pipe(descriptions))
+        # Pretokenize the descriptions for efficiency. Parsing is slow, so
+        # cache the parsed descriptions, and only reuse them if they still
+        # match the descriptions we are using and were parsed by the same
+        # pipeline.
+        tokenized = None
+        tokenized_file = model_results_dir / 'descriptions.spacy'
+        tokenized_meta_file = tokenized_file.with_suffix('.json')
+        tokenized_meta = {
+            'spacy': spacy.__version__,
+            'pipeline': f'{nlp.meta["lang"]}_{nlp.meta["name"]}',
+            'version': nlp.meta['version'],
+            'pipes': nlp.pipe_names,
+        }
+        if tokenized_file.exists() and tokenized_meta_file.exists():
+            with tokenized_meta_file.open('r') as handle:
+                cached_meta = json.load(handle)
+            if cached_meta != tokenized_meta:
+                print('parsed descriptions come from a different pipeline, '
+                      'will reparse')
+            else:
+                print(f'loading parsed descriptions from {tokenized_file}')
+                cached = DocBin().from_disk(tokenized_file).get_docs(nlp.vocab)
+                tokenized = tuple(cached)
+                if [tokens.text for tokens in tokenized] != list(descriptions):
+                    print('parsed descriptions are stale, will reparse')
+                    tokenized = None
+        if tokenized is None:
+            tokenized = tuple(
+                nlp.pipe(descriptions,
+                         batch_size=args.nlp_batch_size,
+                         n_process=args.nlp_n_process))
+            print(f'saving parsed descriptions to {tokenized_file}')
+            DocBin(docs=tokenized).to_disk(tokenized_file)
+            with tokenized_meta_file.open('w') as handle:
+                json.dump(tokenized_meta, handle)
+
+        # Compute every feature the experiments need in one pass.
+        features = precompute_features(tokenized)
+        vectorless = features[FEATURE_VECTORLESS]
+        if vectorless.any():
+            print(f'warning: {vectorless.sum()} descriptions have no vector, '
+                  'will ablate them last in semantic experiments')
 
         # Begin the experiments! For each one, we will ablate neurons in
         # order of some criterion and measure drops in validation accuracy.
+        evaluated: Dict[FrozenSet[Unit], Tuple[float, Dict[str, float]]] = {}
+
+        # Every experiment starts by ablating nothing, so test the unablated
+        # CNN once up front rather than inside whichever experiment runs first.
+        baseline = cnn.evaluate(loader,
+                                display_progress_as='test unablated '
+                                f'{cnn_name}/{dataset_name}',
+                                compile_forward=args.compile_forward,
+                                amp=args.amp,
+                                device=device)
+        evaluated[frozenset()] = (
+            baseline.accuracy,
+            class_accuracies(baseline, dataset.dataset.classes),
+        )
+
         for experiment in sorted(experiments,
                                  key=lambda exp: GROUPS_BY_EXPERIMENT[exp]):
             group = GROUPS_BY_EXPERIMENT[experiment]
@@ -263,101 +491,67 @@ for dataset_name in args.datasets:
                 # and score according to how many words in the description
                 # belong to a synset descended from that one.
                 elif group == GROUP_SEMANTIC:
-                    target = nlp(experiment)
-                    scores = [toks.similarity(target) for toks in tokenized]
-
-                # Group 3: Syntactic ablations. Count the number of times a POS
-                # apears in the description.
-                elif group == GROUP_SYNTACTIC:
-                    pos = {
-                        EXPERIMENT_N_NOUNS: 'NOUN',
-                        EXPERIMENT_N_VERBS: 'VERB',
-                        EXPERIMENT_N_ADPS: 'ADP',
-                        EXPERIMENT_N_ADJS: 'ADJ',
-                    }[experiment]
-                    scores = [
-                        sum(token.pos_ == pos
-                            for token in tokens)
-                        for tokens in tokenized
-                    ]
-
-                # Group 4: Structural ablations. These are all quite different,
-                # so they get their own if branches. Ain't that neat?
-                elif experiment == EXPERIMENT_DESCRIPTION_LENGTH:
-                    assert group == GROUP_STRUCTURAL
-                    scores = [len(tokens) for tokens in tokenized]
-
-                elif experiment == EXPERIMENT_PARSE_DEPTH:
-                    assert group == GROUP_STRUCTURAL
-
-                    scores = []
-                    for tokens in tqdm(tokenized, desc='compute parse depths'):
-                        root = None
-                        for token in tokens:
-                            if token.dep_ == 'ROOT':
-                                root = token
-                        assert root is not None
-
-                        deepest = 0
-                        frontier = [(root, 0)]
-                        while frontier:
-                            current, depth = frontier.pop()
-                            for child in current.children:
-                                frontier.append((child, depth + 1))
-
-                            if depth > deepest:
-                                deepest = depth
-
-                        scores.append(deepest)
-
+                    # NaN scores sort last in either order.
+                    similarities = features[FEATURE_VECTORS] \
+                        @ target_vectors[experiment]
+                    similarities[vectorless] = np.nan
+                    scores = similarities.tolist()
+
+                # Groups 3 and 4: Syntactic and structural ablations. Count
+                # the number of times a POS apears in the description, or
+                # measure its length, parse depth, or the max distance between
+                # any two of its words. All of these are precomputed.
                 else:
-                    assert group == GROUP_STRUCTURAL
-                    assert experiment == EXPERIMENT_MAX_WORD_DIFFERENCE
-                    scores = []
-                    for index, tokens in enumerate(tokenized):
-                        vectors = torch.stack([
-                            torch.from_numpy(token.vector) for token in tokens
-                        ])
-                        distances = vectors[:, None] - vectors[None, :]
-                        distances = (distances**2).sum(dim=-1)
-                        score = distances.max().item()
-                        scores.append(score)
+                    assert group in (GROUP_SYNTACTIC, GROUP_STRUCTURAL)
+                    scores = features[experiment].tolist()
 
                 # No need to load cached scores, they're easily derived...
                 # just always save them for auditing purposes.
-                scores_file = model_results_dir / f'{experiment}-scores.pth'
-                torch.save(scores, scores_file)
-
+                # Write to a temporary file first, so an interrupted run never
+                # leaves a truncated scores file behind.
+                scores_file = model_results_dir / f'{experiment}-scores.npy'
+                scores_tmp_file = scores_file.with_suffix('.npy.tmp')
+                with scores_tmp_file.open('wb') as handle:
+                    np.save(handle, np.asarray(scores, dtype=np.float32))
+                scores_tmp_file.replace(scores_file)
+
+                # Sort stably, so ties stay in unit order either way.
+                keys = np.asarray(scores)
                 for order in args.orders:
-                    indices = sorted(range(len(descriptions)),
-                                     key=lambda i: scores[i],
-                                     reverse=order == ORDER_DECREASING)
+                    if order == ORDER_DECREASING:
+                        indices = np.argsort(-keys, kind='stable').tolist()
+                    else:
+                        indices = np.argsort(keys, kind='stable').tolist()
                     fractions = np.arange(args.ablation_min, args.ablation_max,
                                           args.ablation_step_size)
                     for fraction in fractions:
                         ablated = indices[:int(fraction * len(indices))]
                         units = dissected.units(ablated)
-                        predictions = cnn.predict(
-                            dataset,
-                            ablate=units,
-                            display_progress_as='test ablated '
-                            f'{cnn_name}/{dataset_name} '
-                            f'(cond={experiment}, '
-                            f'trial={trial}, '
-                            f'order={order}, '
-                            f'frac={fraction:.2f})',
-                            device=device)
-                        accuracy = cnn.accuracy(dataset,
-                                                predictions=predictions,
-                                                device=device)
-
-                        # Compute class-by-class breakdown of accuracy.
-                        accuracies = {
-                            f'accuracy-{dataset.dataset.classes[cat]}': acc for
-                            cat, acc in cnn.accuracies(dataset,
-                                                       predictions=predictions,
-                                                       device=device).items()
-                        }
+
+                        # Different experiments, orders, and trials often
+                        # ablate the exact same units (e.g., none at all), so
+                        # only test the CNN on each set of units once.
+                        key = frozenset(units)
+                        if key not in evaluated:
+                            evaluation = cnn.evaluate(
+                                loader,
+                                ablate=units,
+                                display_progress_as='test ablated '
+                                f'{cnn_name}/{dataset_name} '
+                                f'(cond={experiment}, '
+                                f'trial={trial}, '
+                                f'order={order}, '
+                                f'frac={fraction:.2f})',
+                                compile_forward=args.compile_forward,
+                                amp=args.amp,
+                                device=device)
+
+                            evaluated[key] = (
+                                evaluation.accuracy,
+                                class_accuracies(evaluation,
+                                                 dataset.dataset.classes),
+                            )
+                        accuracy, accuracies = evaluated[key]
 
                         # Report to wandb.
                         samples = viz.random_neuron_wandb_images(
@@ -626,7 +626,8 @@ class Decoder(serialize.SerializableModule):
                 inputs_lm = self.lm.embedding(tokens)[:, None]
                 _, (h_lm, c_lm) = self.lm.lstm(inputs_lm, (h_lm, c_lm))
                 assert h_lm is not None and c_lm is not None
-                log_p_w_lm = self.lm.output(h_lm[-1])
+                log_p_w_lm = torch.log_softmax(self.lm.output(h_lm[-1]),
+                                               dim=-1)
             predictions = log_p_w - temperature * log_p_w_lm
 
         return DecoderStep(predictions=predictions,
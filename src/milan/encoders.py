@@ -4,12 +4,13 @@ These map image regions (given by an image and a mask) to a single vector.
 They do so by feeding the images to a pretrained image classifier, reading
 its intermediate features, and applying the mask to those features.
 """
-from typing import (Any, Callable, Mapping, Optional, Sequence, Tuple, Type,
-                    Union, overload)
+import functools
+from typing import (Any, Callable, Dict, List, Mapping, Optional, Sequence,
+                    Sized, Tuple, Type, Union, cast, overload)
 
 from src.deps.netdissect import nethook, renormalize
 from src.milannotations import datasets
-from src.utils import serialize
+from src.utils import env, serialize
 from src.utils.typing import Device
 
 import torch
@@ -19,6 +20,9 @@ from torch.utils import data
 from torchvision import models
 from tqdm.auto import tqdm
 
+# A captured forward pass: the graph, its static inputs, and its static output.
+CapturedForward = Tuple[Any, Sequence[torch.Tensor], torch.Tensor]
+
 
 class Encoder(serialize.SerializableModule):
     """An abstract module mapping images (and optionally masks) to features."""
@@ -67,6 +71,8 @@ class Encoder(serialize.SerializableModule):
             num_workers: int = 0,
             device: Optional[Device] = None,
             display_progress_as: Union[bool, str] = True,
+            cuda_graphs: bool = False,
+            compile_forward: bool = False,
             **kwargs: Any) -> data.TensorDataset:
         """Featurize an entire dataset.
 
@@ -94,22 +100,55 @@ class Encoder(serialize.SerializableModule):
                 progress bar with this key. If True, show progress bar and
                 generate the key. If False, do not show progress bar. Defaults
                 to True.
+            cuda_graphs (bool, optional): Capture the forward pass in a CUDA
+                graph once per distinct batch shape and replay it for every
+                batch, skipping per-kernel launch overhead. Requires `device`
+                to be a CUDA device. Defaults to False.
+            compile_forward (bool, optional): Run the forward pass through
+                `torch.compile` in "reduce-overhead" mode, which fuses the
+                pooling ops and uses CUDA graphs on its own. Cannot be combined
+                with `cuda_graphs`. Defaults to False.
 
         Raises:
-            ValueError: If images or masks are not tensors.
+            ValueError: If images or masks are not tensors, if `cuda_graphs`
+                is set but `device` is not a CUDA device or torch cannot
+                capture graphs, if `compile_forward` is set but torch cannot
+                compile, or if both `cuda_graphs` and `compile_forward` are
+                set.
 
         Returns:
             data.TensorDataset: Dataset of image features.
 
         """
+        on_cuda = device is not None and torch.device(device).type == 'cuda'
+        if compile_forward and not hasattr(torch, 'compile'):
+            raise ValueError('compile_forward requires torch>=2.0')
+        if cuda_graphs and not hasattr(torch.cuda, 'graph'):
+            raise ValueError('cuda_graphs requires torch>=1.10')
+        if cuda_graphs and not on_cuda:
+            raise ValueError(f'cuda_graphs requires cuda device, got {device}')
+        if cuda_graphs and compile_forward:
+            raise ValueError('cannot set both cuda_graphs and compile_forward')
         if device is not None:
             self.to(device)
 
-        mapped = []
+        forward: Callable[..., torch.Tensor] = self
+        if compile_forward:
+            forward = torch.compile(self,
+                                    mode='reduce-overhead',
+                                    dynamic=False)
+
+        mapped: Optional[torch.Tensor] = None
+        offset = 0
+        graphs: Dict[Tuple[torch.Size, ...], CapturedForward] = {}
 
+        # Pinned host memory lets us issue async copies to the GPU, so the
+        # next batch can transfer while the current one is being featurized.
         loader = data.DataLoader(dataset,
                                  batch_size=batch_size,
-                                 num_workers=num_workers)
+                                 num_workers=num_workers,
+                                 pin_memory=on_cuda,
+                                 persistent_workers=num_workers > 0)
         if isinstance(display_progress_as, str) or display_progress_as:
             if not isinstance(display_progress_as, str):
                 if isinstance(dataset, (datasets.TopImagesDataset,
@@ -119,33 +158,89 @@ class Encoder(serialize.SerializableModule):
                     display_progress_as = 'featurize dataset'
             loader = tqdm(loader, desc=display_progress_as)
 
-        for batch in loader:
-            images = batch[image_index]
-            if not isinstance(images, torch.Tensor):
-                raise ValueError(f'non-tensor images: {type(images).__name__}')
-            if device is not None:
-                images = images.to(device)
-            inputs = [images.view(-1, *images.shape[-3:])]
-
-            masks = None
-            if mask:
-                masks = batch[mask_index]
-                if not isinstance(masks, torch.Tensor):
+        # Leave cores free for loader workers if we are computing on CPU. On
+        # CUDA, every batch but the last has the same shape, so let cuDNN
+        # pick the fastest conv algorithms for it.
+        with env.cpu_threads(num_workers, device=device), \
+                env.cudnn_benchmark(device=device):
+            for batch in loader:
+                images = batch[image_index]
+                if not isinstance(images, torch.Tensor):
                     raise ValueError(
-                        f'non-tensor masks: {type(masks).__name__}')
+                        f'non-tensor images: {type(images).__name__}')
                 if device is not None:
-                    masks = masks.to(device)
-                inputs.append(masks.view(-1, *masks.shape[-3:]))
+                    images = images.to(device, non_blocking=True)
+                inputs = [images.view(-1, *images.shape[-3:])]
+
+                masks = None
+                if mask:
+                    masks = batch[mask_index]
+                    if not isinstance(masks, torch.Tensor):
+                        raise ValueError(
+                            f'non-tensor masks: {type(masks).__name__}')
+                    if device is not None:
+                        masks = masks.to(device, non_blocking=True)
+                    inputs.append(masks.view(-1, *masks.shape[-3:]))
+
+                with torch.inference_mode():
+                    if cuda_graphs:
+                        features = self._replay(graphs, inputs, **kwargs)
+                    else:
+                        features = forward(*inputs, **kwargs)
+
+                # Unflatten the outputs.
+                features = features.view(*images.shape[:-3],
+                                         *self.feature_shape)
+
+                # Write straight into one output buffer, allocated once we
+                # know the shape of each sample. This also copies compiled and
+                # replayed outputs before the next call overwrites them.
+                if mapped is None:
+                    size = len(cast(Sized, dataset))
+                    mapped = features.new_empty((size, *features.shape[1:]))
+                mapped[offset:offset + len(features)].copy_(features)
+                offset += len(features)
+
+        assert mapped is not None, 'empty dataset?'
+        return data.TensorDataset(mapped)
+
+    def _replay(self, graphs: Dict[Tuple[torch.Size, ...], CapturedForward],
+                inputs: Sequence[torch.Tensor], **kwargs: Any) -> torch.Tensor:
+        """Run `forward` by replaying a CUDA graph, capturing it if needed.
+
+        Keyword arguments are passed to `forward`.
+
+        Args:
+            graphs (Dict[Tuple[torch.Size, ...], CapturedForward]): Graphs
+                captured so far, keyed by input shapes. Updated in place.
+            inputs (Sequence[torch.Tensor]): Inputs to `forward`.
+
+        Returns:
+            torch.Tensor: The output of `forward`. This is the graph's static
+                output, so it is overwritten on the next replay.
 
-            with torch.no_grad():
-                features = self(*inputs, **kwargs)
+        """
+        key = tuple(input.shape for input in inputs)
+        if key not in graphs:
+            captured = [input.clone() for input in inputs]
 
-            # Unflatten the outputs.
-            features = features.view(*images.shape[:-3], *self.feature_shape)
+            # Capture only works after a warmup run on a side stream.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self(*captured, **kwargs)
+            torch.cuda.current_stream().wait_stream(stream)
 
-            mapped.append(features)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                output = self(*captured, **kwargs)
+            graphs[key] = (graph, captured, output)
 
-        return data.TensorDataset(torch.cat(mapped))
+        graph, statics, output = graphs[key]
+        for static, input in zip(statics, inputs):
+            static.copy_(input, non_blocking=True)
+        graph.replay()
+        return output
 
 
 ClassifierFactory = Callable[..., nn.Sequential]
@@ -272,9 +367,20 @@ class PyramidConvEncoder(Encoder, serialize.SerializableModule):
 
         factory, layers, feature_size = configs[config]
         self.encoder = nethook.InstrumentedModel(factory(**self.kwargs))
-        self.encoder.retain_layers(layers)
         self.encoder.eval()
 
+        # Record layer activations with plain forward hooks that write into a
+        # fixed slot per layer, rather than having nethook rebuild a dict of
+        # retained features on every batch.
+        self._features: List[Optional[torch.Tensor]] = [None] * len(layers)
+        for index, layer in enumerate(layers):
+            module = self.encoder.model.get_submodule(layer)
+            module.register_forward_hook(functools.partial(
+                self._retain, index))
+
+        # Channels-last convolutions are considerably faster on tensor cores.
+        self.encoder.to(memory_format=torch.channels_last)
+
         self.layers = layers
         self.feature_shape = (feature_size,)
 
@@ -287,38 +393,85 @@ class PyramidConvEncoder(Encoder, serialize.SerializableModule):
                 images: torch.Tensor,
                 masks: Optional[torch.Tensor] = None,
                 normalize: bool = True,
+                amp: bool = False,
+                skip_empty: bool = False,
                 **_: Any) -> torch.Tensor:
-        """Construct pyramid features."""
+        """Construct pyramid features.
+
+        If `amp` is set, the classifier runs under autocast (in float16 on
+        CUDA and bfloat16 elsewhere), but features are still pooled in float32
+        so the sums over each feature map do not lose precision.
+
+        Images whose masks are all zeros always get all-zero features. By
+        default they still run through the classifier, which keeps the batch
+        shape static (as CUDA graphs and compiled forwards require). If
+        `skip_empty` is set, they are dropped from the batch beforehand
+        instead, saving classifier work at the cost of a host sync and a
+        data-dependent batch size.
+        """
         if masks is None:
             masks = images.new_ones((len(images), 1, *images.shape[2:]))
+        if skip_empty:
+            valid = masks.flatten(1).abs().amax(dim=-1).gt(1e-8)
+            if not valid.all():
+                encoded = images.new_zeros((len(images), *self.feature_shape))
+                if valid.any():
+                    encoded[valid] = self(images[valid],
+                                          masks[valid],
+                                          normalize=normalize,
+                                          amp=amp)
+                return encoded
         if normalize:
             images = (images - self.mean) / self.std
-
-        # Feed images to encoder, letting nethook record layer activations.
-        self.encoder(images)
-        features = self.encoder.retained_features(clear=True).values()
-
-        # Mask the features at each level of the pyramid.
+        images = images.contiguous(memory_format=torch.channels_last)
+
+        # Feed images to encoder, letting the hooks record layer activations.
+        with env.autocast(images.device, enabled=amp):
+            self.encoder(images)
+        features = []
+        for index, fs in enumerate(self._features):
+            assert fs is not None, f'layer {self.layers[index]} not run?'
+            features.append(fs.float())
+            self._features[index] = None
+
+        # Downsample the masks once per distinct feature map size, since
+        # several levels can share one (e.g., the last three AlexNet convs).
+        # Masks that vanish at a given size cannot be normalized, so rather
+        # than filtering them out (which needs a host sync and changes the
+        # batch shape), zero their normalizers and let them pool to zeros.
+        pyramid = {}
+        for fs in features:
+            size = fs.shape[-2:]
+            if size not in pyramid:
+                ms = functional.interpolate(masks,
+                                            size=size,
+                                            mode='bilinear',
+                                            align_corners=False).squeeze(1)
+                valid = ms.abs().amax(dim=(-1, -2)).gt(1e-8)
+                scales = ms.sum(dim=(-1, -2))\
+                    .clamp_min(1e-8)\
+                    .reciprocal()\
+                    .mul(valid)\
+                    .unsqueeze(-1)
+                pyramid[size] = (ms, scales)
+
+        # Mask the features at each level of the pyramid. Pool them with a
+        # single batched contraction, then normalize so the masks act more
+        # like attention. Normalizing the pooled features is equivalent to
+        # normalizing the masks, but touches far less memory.
         masked = []
         for fs in features:
-            ms = functional.interpolate(masks,
-                                        size=fs.shape[-2:],
-                                        mode='bilinear',
-                                        align_corners=False)
-
-            # Normalize the masks so they look more like attention. If any
-            # of them are all zeros, we'll end up with divide-by-zero errors.
-            zeros = torch.zeros_like(ms)
-            valid = ~ms.isclose(zeros).all(dim=-1).all(dim=-1).view(-1)
-            indices = valid.nonzero().squeeze()
-            ms[indices] /= ms[indices].sum(dim=(-1, -2), keepdim=True)
-
-            # Pool features and move on.
-            mfs = fs.mul(ms).sum(dim=(-1, -2))
+            ms, scales = pyramid[fs.shape[-2:]]
+            mfs = torch.einsum('bchw,bhw->bc', fs, ms) * scales
             masked.append(mfs)
 
         return torch.cat(masked, dim=-1)
 
+    def _retain(self, index: int, module: nn.Module, inputs: Any,
+                output: torch.Tensor) -> None:
+        """Store the output of the index-th layer in `layers`."""
+        self._features[index] = output.detach()
+
     def properties(self) -> serialize.Properties:
         """Override `Serializable.properties`."""
         return {'config': self.config, **self.kwargs}
@@ -3,17 +3,52 @@
 This is integrated with the decoder to compute PMI instead of probability
 while decoding descriptions.
 """
-from typing import Any, Mapping, Optional, Sequence, Sized, Type, Union, cast
+import copy
+from concurrent import futures
+from typing import (Any, Callable, Dict, List, Mapping, Optional, Sequence,
+                    Sized, Type, Union, cast)
 
 from src.utils import lang, serialize, training
 from src.utils.typing import Device, StrSequence
 
 import torch
 from torch import nn, optim
+from torch.nn.utils import rnn
 from torch.utils import data
 from tqdm.auto import tqdm
 
 
+class SequenceDataset(data.Dataset):
+    """A wrapper dataset that uses just the annotation sequences."""
+
+    def __init__(self, dataset: data.Dataset, annotation_index: int = 4):
+        """Read every sequence from the dataset once.
+
+        Args:
+            dataset (data.Dataset): The wrapped dataset.
+            annotation_index (int, optional): Index of the sequence (or
+                sequences) in each dataset sample. Defaults to 4 to be
+                compatible with `AnnotatedTopImagesDataset`.
+
+        """
+        sequences: List[str] = []
+        for index in range(len(cast(Sized, dataset))):
+            annotation = dataset[index][annotation_index]
+            if isinstance(annotation, str):
+                sequences.append(annotation)
+            else:
+                sequences.extend(annotation)
+        self.sequences = tuple(sequences)
+
+    def __getitem__(self, index: int) -> str:
+        """Return the index-th sequence."""
+        return self.sequences[index]
+
+    def __len__(self) -> int:
+        """Return the number of sequences."""
+        return len(self.sequences)
+
+
 class LanguageModel(serialize.SerializableModule):
     """A simple LSTM language model."""
 
@@ -52,13 +87,14 @@ class LanguageModel(serialize.SerializableModule):
                             num_layers=layers,
                             dropout=dropout,
                             batch_first=True)
-        self.output = nn.Sequential(nn.Linear(hidden_size, len(indexer)),
-                                    nn.LogSoftmax(dim=-1))
+        self.output = nn.Linear(hidden_size, len(indexer))
 
     def forward(self,
                 inputs: torch.Tensor,
                 reduce: bool = False,
-                masks: Optional[torch.Tensor] = None) -> torch.Tensor:
+                masks: Optional[torch.Tensor] = None,
+                return_log_probs: bool = True,
+                lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
         """Compute the log probability of the given sequence.
 
         Args:
@@ -74,41 +110,84 @@ class LanguageModel(serialize.SerializableModule):
                 probabilities when reducing (e.g., to ignore specific tokens).
                 Must have shape (batch_size, len(inputs) - 1). By default,
                 everything after the first stop token is masked.
+            return_log_probs (bool, optional): If unset, return unnormalized
+                token logits instead of log probabilities. Ignored if `reduce`
+                is set. Defaults to True.
+            lengths (Optional[torch.Tensor], optional): CPU tensor of shape
+                (batch_size,) giving how many leading tokens of each sequence
+                the LSTM needs to read; outputs past that are zeroed. By
+                default, this is everything up to the last non-pad token,
+                which costs a device-to-host sync to compute.
 
         Returns:
             torch.Tensor: Shape (batch_size, len(inputs), vocab_size) tensor of
-                log probabilites for each token, or shape (batch_size,) tensor
-                containing log probabilities for each sequence if `reduce` is
-                set.
+                log probabilites (or logits) for each token, or shape
+                (batch_size,) tensor containing log probabilities for each
+                sequence if `reduce` is set.
 
         """
+        batch_size, length = inputs.shape
         embeddings = self.embedding(inputs)
-        hiddens, _ = self.lstm(embeddings)
-        lps = self.output(hiddens)
-        if reduce:
-            batch_size, length = inputs.shape
-            idx_batch = torch.arange(batch_size).repeat_interleave(length - 1)
-            idx_time = torch.arange(length - 1).repeat(batch_size)
-            idx_tokens = inputs[:, 1:].reshape(-1)
-            if masks is None:
-                masks = inputs.new_ones((batch_size, length - 1))
-                for i, j in inputs.eq(self.indexer.stop_index).nonzero():
-                    masks[i, j + 1:] = 0
-            lps = lps[:, :-1][idx_batch, idx_time, idx_tokens]\
-                .view(batch_size, length - 1)\
-                .mul(masks)\
-                .sum(dim=-1)
-        return lps
-
-    def logp(self,
-             sequences: StrSequence,
-             device: Optional[Device] = None) -> torch.Tensor:
+
+        # If sequences end in padding, pack them so the LSTM skips the pads.
+        if lengths is None:
+            positions = torch.arange(1, length + 1, device=inputs.device)
+            lengths = inputs.ne(self.indexer.pad_index)\
+                .mul(positions)\
+                .amax(dim=-1)\
+                .clamp_min(1)\
+                .cpu()
+        if lengths.min() < length:
+            packed = rnn.pack_padded_sequence(embeddings,
+                                              lengths,
+                                              batch_first=True,
+                                              enforce_sorted=False)
+            hiddens, _ = rnn.pad_packed_sequence(self.lstm(packed)[0],
+                                                 batch_first=True,
+                                                 total_length=length)
+        else:
+            hiddens, _ = self.lstm(embeddings)
+
+        logits = self.output(hiddens)
+        if not reduce:
+            if return_log_probs:
+                return torch.log_softmax(logits, dim=-1)
+            return logits
+
+        if masks is None:
+            # Mask every token after the first stop token, i.e., every
+            # prediction made at or after the first stop token. Otherwise
+            # sequences would score differently depending on their padding.
+            stops = inputs.eq(self.indexer.stop_index).long()
+            masks = stops.cumsum(dim=-1)[:, :-1].eq(0)
+
+        # Normalize only the gathered logits instead of materializing the full
+        # log softmax over the vocabulary.
+        logits = logits[:, :-1]
+        lps = logits\
+            .gather(-1, inputs[:, 1:].unsqueeze(-1))\
+            .squeeze(-1)\
+            .sub(logits.logsumexp(dim=-1))
+        return lps.mul(masks).sum(dim=-1)
+
+    def logp(
+        self,
+        sequences: StrSequence,
+        device: Optional[Device] = None,
+        batch_size: int = 128,
+        display_progress_as: Optional[str] = 'compute lm probs',
+    ) -> torch.Tensor:
         """Compute log probability of each sequence.
 
+        Sequences are tokenized and indexed on a background thread, one batch
+        ahead of the batch the model is currently processing.
+
         Args:
             sequences (StrSequence): Text sequences.
             device (Optional[Device], optional): Send this model and all
                 tensors to this device. Defaults to None.
+            batch_size (int, optional): Number of sequences to process at
+                once. Defaults to 128.
             display_progress_as (Optional[str], optional): Show progress bar
                 with this message if set. Defaults to 'compute lm probs'.
 
@@ -121,15 +200,58 @@ class LanguageModel(serialize.SerializableModule):
             self.to(device)
         self.eval()
 
-        inputs = torch.tensor(self.indexer(sequences,
-                                           start=True,
-                                           stop=True,
-                                           pad=True,
-                                           unk=True),
-                              device=device)
-        with torch.no_grad():
-            logps = self(inputs, reduce=True)
-        return logps
+        pin_memory = device is not None and torch.device(device).type == 'cuda'
+
+        def index(start: int) -> torch.Tensor:
+            inputs = torch.tensor(
+                self.indexer(sequences[start:start + batch_size],
+                             start=True,
+                             stop=True,
+                             pad=True,
+                             unk=True))
+            return inputs.pin_memory() if pin_memory else inputs
+
+        starts = range(0, len(sequences), batch_size)
+        progress = starts
+        if display_progress_as is not None:
+            progress = tqdm(starts, desc=display_progress_as)
+
+        logps = []
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            upcoming = executor.submit(index, 0)
+            for start in progress:
+                inputs = upcoming.result().to(device, non_blocking=True)
+                if start + batch_size < len(sequences):
+                    upcoming = executor.submit(index, start + batch_size)
+                with torch.no_grad():
+                    logps.append(self(inputs, reduce=True))
+
+        if not logps:
+            return torch.zeros(0, device=device)
+        return torch.cat(logps)
+
+    def quantize_for_cpu(self) -> 'LanguageModel':
+        """Return a copy of this LM with int8 weights for CPU inference.
+
+        The LSTM and output layer are dynamically quantized, so their matmuls
+        run as int8 kernels while activations stay in floating point. The
+        embedding is left alone. The copy is only meant for inference on CPU
+        (e.g., with `logp`); this LM is not modified.
+
+        Returns:
+            LanguageModel: The quantized copy, in eval mode.
+
+        """
+        # Older torch versions (like the 1.9 we pin) only have the
+        # quantization API under its pre-1.10 name.
+        quantization = (torch.ao.quantization
+                        if hasattr(torch, 'ao') else torch.quantization)
+
+        quantized = copy.deepcopy(self).cpu().eval()
+        quantization.quantize_dynamic(quantized, {nn.LSTM, nn.Linear},
+                                      dtype=torch.qint8,
+                                      inplace=True)
+        return quantized
 
     def fit(self,
             dataset: data.Dataset,
@@ -141,7 +263,9 @@ class LanguageModel(serialize.SerializableModule):
             optimizer_t: Type[optim.Optimizer] = optim.AdamW,
             optimizer_kwargs: Optional[Mapping[str, Any]] = None,
             device: Optional[Device] = None,
-            display_progress_as: Optional[str] = 'train lm') -> None:
+            display_progress_as: Optional[str] = 'train lm',
+            compile_forward: bool = False,
+            num_workers: int = 0) -> None:
         """Train this LM on the given dataset.
 
         Args:
@@ -167,64 +291,90 @@ class LanguageModel(serialize.SerializableModule):
             display_progress_as (Optional[str], optional): Show a progress bar
                 prefixed with this message while training.
                 Defaults to 'train lm'.
+            compile_forward (bool, optional): Run the forward pass through
+                `torch.compile` while training. Batches are padded to their
+                longest sequence, so this uses the default mode rather than
+                "reduce-overhead", whose CUDA graphs would be recaptured for
+                every new length. Defaults to False.
+            num_workers (int, optional): Number of worker processes to use in
+                the `torch.utils.data.DataLoader`. Workers persist across
+                epochs. Defaults to 0.
+
+        Raises:
+            ValueError: If `compile_forward` is set but torch cannot compile.
 
         """
+        if compile_forward and not hasattr(torch, 'compile'):
+            raise ValueError('compile_forward requires torch>=2.0')
         if optimizer_kwargs is None:
             optimizer_kwargs = {}
         if device is not None:
             self.to(device)
 
-        # An anonymous wrapper dataset that uses just the sequences.
-        class SequenceDataset(data.Dataset):
-
-            def __init__(self,
-                         dataset: data.Dataset,
-                         annotation_index: int = 4):
-                self.sequences = []
-                for index in range(len(cast(Sized, dataset))):
-                    annotation = dataset[index][annotation_index]
-                    if isinstance(annotation, str):
-                        self.sequences.append(annotation)
-                    else:
-                        self.sequences += annotation
-
-            def __getitem__(self, index: int) -> str:
-                return self.sequences[index]
+        forward: Callable[..., torch.Tensor] = self
+        if compile_forward:
+            forward = torch.compile(self)
 
-            def __len__(self) -> int:
-                return len(self.sequences)
-
-        # Prepare training data.
+        # Prepare training data. Tokenize and index every sequence once up
+        # front, rather than once per batch per epoch. Sequences are padded to
+        # the longest one overall and trimmed to the longest one in each batch.
+        # Inputs and targets are the same sequence shifted by one token, so
+        # keep one compact buffer with both start and stop tokens and slice it
+        # on the device.
         dataset = SequenceDataset(dataset, annotation_index=annotation_index)
+        sequences = torch.tensor(self.indexer(dataset.sequences,
+                                              start=True,
+                                              stop=True,
+                                              pad=True,
+                                              unk=True),
+                                 dtype=torch.int32)
+        lengths = sequences.ne(self.indexer.pad_index).sum(dim=-1).sub(1)
+        indexed = data.TensorDataset(sequences, lengths)
         if isinstance(hold_out, float):
-            train, val = training.random_split(dataset, hold_out=hold_out)
+            train, val = training.random_split(indexed, hold_out=hold_out)
         else:
-            train, val = training.fixed_split(dataset, hold_out)
+            train, val = training.fixed_split(indexed, hold_out)
+
+        # Batch sequences of similar length together to minimize padding.
+        # The split indices may be any int sequence, and tensors treat tuples
+        # as multi-dimensional indices, so index with lists.
+        train_lengths = lengths[list(train.indices)].tolist()
+        val_lengths = lengths[list(val.indices)].tolist()
+        pin_memory = device is not None and torch.device(device).type == 'cuda'
         train_loader = data.DataLoader(train,
-                                       batch_size=batch_size,
-                                       shuffle=True)
-        val_loader = data.DataLoader(val, batch_size=batch_size)
+                                       batch_sampler=training.BucketSampler(
+                                           train_lengths,
+                                           batch_size=batch_size,
+                                           shuffle=True),
+                                       num_workers=num_workers,
+                                       pin_memory=pin_memory,
+                                       persistent_workers=num_workers > 0)
+        val_loader = data.DataLoader(val,
+                                     batch_sampler=training.BucketSampler(
+                                         val_lengths,
+                                         batch_size=batch_size,
+                                         shuffle=False),
+                                     num_workers=num_workers,
+                                     pin_memory=pin_memory,
+                                     persistent_workers=num_workers > 0)
 
         # Prepare optimizer, loss, training utils.
         optimizer = optimizer_t(self.parameters(), **optimizer_kwargs)
-        criterion = nn.NLLLoss(ignore_index=self.indexer.pad_index)
+        criterion = nn.CrossEntropyLoss(ignore_index=self.indexer.pad_index)
         stopper = training.EarlyStopping(patience=patience)
 
-        def lossify(sequences: StrSequence) -> torch.Tensor:
-            inputs = torch.tensor(self.indexer(sequences,
-                                               start=True,
-                                               stop=False,
-                                               pad=True,
-                                               unk=True),
-                                  device=device)
-            targets = torch.tensor(self.indexer(sequences,
-                                                start=False,
-                                                stop=True,
-                                                pad=True,
-                                                unk=True),
-                                   device=device)
-            predictions = self(inputs)
-            return criterion(predictions.permute(0, 2, 1), targets)
+        def lossify(sequences: torch.Tensor,
+                    lengths: torch.Tensor) -> torch.Tensor:
+            length = int(lengths.max())
+            sequences = sequences[:, :length + 1]\
+                .to(device, non_blocking=True)\
+                .long()
+            inputs, targets = sequences[:, :-1], sequences[:, 1:]
+
+            # We already know every length on the host, so pass them in rather
+            # than having forward read them back from the device.
+            logits = forward(inputs, return_log_probs=False, lengths=lengths)
+            return criterion(logits.permute(0, 2, 1), targets)
 
         progress = range(max_epochs)
         if display_progress_as is not None:
@@ -233,23 +383,24 @@ class LanguageModel(serialize.SerializableModule):
         # Begin training!
         best = self.state_dict()
         for _ in progress:
+            # Accumulate losses on the device and sync once per epoch, so the
+            # device never has to drain between steps.
             self.train()
-            train_loss = 0.
-            for sequences in train_loader:
-                loss = lossify(sequences)
+            train_losses = torch.zeros((), device=device)
+            for batch in train_loader:
+                loss = lossify(*batch)
                 loss.backward()
                 optimizer.step()
-                optimizer.zero_grad()
-                train_loss += loss.item()
-            train_loss /= len(train_loader)
+                optimizer.zero_grad(set_to_none=True)
+                train_losses += loss.detach()
+            train_loss = train_losses.item() / len(train_loader)
 
             self.eval()
-            val_loss = 0.
-            for sequences in val_loader:
+            val_losses = torch.zeros((), device=device)
+            for batch in val_loader:
                 with torch.no_grad():
-                    loss = lossify(sequences)
-                val_loss += loss.item()
-            val_loss /= len(val_loader)
+                    val_losses += lossify(*batch)
+            val_loss = val_losses.item() / len(val_loader)
 
             if display_progress_as is not None:
                 assert not isinstance(progress, range)
@@ -264,6 +415,15 @@ class LanguageModel(serialize.SerializableModule):
             if stopper.improved:
                 best = self.state_dict()
 
+    def _load_from_state_dict(self, state_dict: Dict[str, Any], prefix: str,
+                              *args: Any, **kwargs: Any) -> None:
+        """Load checkpoints saved when `output` ended in a LogSoftmax."""
+        for key in ('weight', 'bias'):
+            legacy = f'{prefix}output.0.{key}'
+            if legacy in state_dict:
+                state_dict[f'{prefix}output.{key}'] = state_dict.pop(legacy)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def properties(self) -> serialize.Properties:
         """Override `Serializable.properties`."""
         return {
@@ -1,11 +1,11 @@
 """Utilities for altering unit activations real-time."""
 import collections
 import contextlib
-from typing import (Any, Callable, Dict, Iterator, Mapping, Optional, Sequence,
-                    Sized, Type, Union, cast)
+from typing import (Any, Callable, Iterator, Mapping, NamedTuple, Optional,
+                    Sequence, Sized, Tuple, Type, Union, cast)
 
 from src.deps.netdissect import nethook
-from src.utils import training
+from src.utils import env, training
 from src.utils.typing import Device, Layer, Unit
 
 import torch
@@ -70,6 +70,23 @@ def ablated(
         yield instrumented
 
 
+class ClassifierEvaluation(NamedTuple):
+    """Wraps the results of testing a classifier on a dataset.
+
+    Fields:
+        predictions (torch.Tensor): Long tensor containing class predictions
+            for every item in the dataset, with shape (len(dataset),).
+        accuracy (float): Accuracy on the dataset.
+        accuracies (Mapping[int, float]): Class-by-class accuracy on the
+            dataset, for every class that appears in it.
+
+    """
+
+    predictions: torch.Tensor
+    accuracy: float
+    accuracies: Mapping[int, float]
+
+
 class ImageClassifier(nn.Module):
     """Wraps an image classifier and adds some ablation utilities."""
 
@@ -101,7 +118,8 @@ class ImageClassifier(nn.Module):
             ablate: Optional[Sequence[Unit]] = None,
             layers: Optional[Sequence[Layer]] = None,
             device: Optional[Device] = None,
-            display_progress_as: Optional[str] = 'train classifer') -> None:
+            display_progress_as: Optional[str] = 'train classifer',
+            compile_forward: bool = False) -> None:
         """Train the classifier on the given dataset.
 
         Args:
@@ -133,8 +151,15 @@ class ImageClassifier(nn.Module):
                 tensors to this device. Defaults to None.
             display_progress_as (Optional[str], optional): Show a progress bar
                 with this label while training. Defaults to 'train classifer'.
+            compile_forward (bool, optional): Run the (ablated) forward pass
+                through `torch.compile` while training. Defaults to False.
+
+        Raises:
+            ValueError: If `compile_forward` is set but torch cannot compile.
 
         """
+        if compile_forward and not hasattr(torch, 'compile'):
+            raise ValueError('compile_forward requires torch>=2.0')
         if device is not None:
             self.to(device)
         if optimizer_kwargs is None:
@@ -145,13 +170,20 @@ class ImageClassifier(nn.Module):
         else:
             train, val = training.fixed_split(dataset, hold_out)
 
+        # Pinned host memory lets batches copy to the GPU asynchronously, and
+        # persistent workers are not respawned every epoch.
+        pin_memory = device is not None and torch.device(device).type == 'cuda'
         train_loader = data.DataLoader(train,
                                        batch_size=batch_size,
                                        num_workers=num_workers,
-                                       shuffle=True)
+                                       shuffle=True,
+                                       pin_memory=pin_memory,
+                                       persistent_workers=num_workers > 0)
         val_loader = data.DataLoader(val,
                                      batch_size=batch_size,
-                                     num_workers=num_workers)
+                                     num_workers=num_workers,
+                                     pin_memory=pin_memory,
+                                     persistent_workers=num_workers > 0)
 
         if layers is None:
             parameters = list(self.parameters())
@@ -176,14 +208,18 @@ class ImageClassifier(nn.Module):
             progress = tqdm(progress, desc=display_progress_as)
 
         with ablated(self.model, ablate or []) as model:
+            forward: Callable[..., torch.Tensor] = model
+            if compile_forward:
+                forward = torch.compile(model)
+
             best = self.state_dict()
             for _ in progress:
                 model.train()
                 train_loss = 0.
                 for batch in train_loader:
-                    images = batch[image_index].to(device)
-                    targets = batch[target_index].to(device)
-                    predictions = model(images)
+                    images = batch[image_index].to(device, non_blocking=True)
+                    targets = batch[target_index].to(device, non_blocking=True)
+                    predictions = forward(images)
                     loss = criterion(predictions, targets)
                     loss.backward()
                     optimizer.step()
@@ -194,10 +230,10 @@ class ImageClassifier(nn.Module):
                 model.eval()
                 val_loss = 0.
                 for batch in val_loader:
-                    images = batch[image_index].to(device)
-                    targets = batch[target_index].to(device)
-                    with torch.no_grad():
-                        predictions = model(images)
+                    images = batch[image_index].to(device, non_blocking=True)
+                    targets = batch[target_index].to(device, non_blocking=True)
+                    with torch.inference_mode():
+                        predictions = forward(images)
                         loss = criterion(predictions, targets)
                     val_loss += loss.item()
                 val_loss /= len(val_loader)
@@ -217,18 +253,23 @@ class ImageClassifier(nn.Module):
 
     def predict(
         self,
-        dataset: data.Dataset,
+        dataset: Union[data.Dataset, data.DataLoader],
         image_index: int = 0,
         batch_size: int = 128,
         num_workers: int = 0,
         ablate: Optional[Sequence[Unit]] = None,
         device: Optional[Device] = None,
         display_progress_as: Optional[str] = 'classify images',
+        compile_forward: bool = False,
+        amp: bool = False,
     ) -> torch.Tensor:
         """Run the model on every element in the dataset.
 
         Args:
-            dataset (data.Dataset): The dataset.
+            dataset (Union[data.Dataset, data.DataLoader]): The dataset, or a
+                loader over it. Pass a loader to reuse it (and its workers)
+                across calls, in which case `batch_size` and `num_workers` are
+                ignored.
             image_index (int, optional): Index of images in dataset.
                 Defaults to 0 to be compatible with
                 `torchvision.datasets.ImageFolder`.
@@ -242,31 +283,145 @@ class ImageClassifier(nn.Module):
                 tensors to this device. Defaults to None.
             display_progress_as (Optional[str], optional): Show a progress bar
                 with this message while testing. Defaults to 'test classifier'.
+            compile_forward (bool, optional): Run the (ablated) forward pass
+                through `torch.compile` in "reduce-overhead" mode, which
+                replays it as a CUDA graph on CUDA devices. Compilation happens
+                once per call and per batch shape, so this pays off on large
+                datasets. Defaults to False.
+            amp (bool, optional): Run the forward pass under autocast, in
+                float16 on CUDA and bfloat16 elsewhere. Defaults to False.
+
+        Raises:
+            ValueError: If `compile_forward` is set but torch cannot compile,
+                or if `amp` is set but torch cannot autocast.
 
         Returns:
             torch.Tensor: Long tensor containing class predictions for every
                 item in the dataset, with shape (len(dataset),).
 
         """
+        predictions = [
+            logits.argmax(dim=-1) for _, logits in self._classify(
+                dataset,
+                image_index=image_index,
+                batch_size=batch_size,
+                num_workers=num_workers,
+                ablate=ablate,
+                device=device,
+                display_progress_as=display_progress_as,
+                compile_forward=compile_forward,
+                amp=amp)
+        ]
+        return torch.cat(predictions)
+
+    def evaluate(
+        self,
+        dataset: Union[data.Dataset, data.DataLoader],
+        target_index: int = 1,
+        device: Optional[Device] = None,
+        display_progress_as: Optional[str] = 'test classifier',
+        **kwargs: Any,
+    ) -> ClassifierEvaluation:
+        """Classify every image in the dataset and score the predictions.
+
+        Equivalent to calling `predict`, `accuracy`, and `accuracies`, but
+        only reads the dataset once and counts correct predictions per class
+        on the device as it goes. The **kwargs are forwarded to
+        `ImageClassifier.predict`.
+
+        Args:
+            dataset (Union[data.Dataset, data.DataLoader]): The dataset, or a
+                loader over it. See `ImageClassifier.predict`.
+            target_index (int, optional): Index of target labels in dataset.
+                Defaults to 1 to be compatible with
+                `torchvision.datasets.ImageFolder`.
+            device (Optional[Device], optional): Send this model and all
+                tensors to this device. Defaults to None.
+            display_progress_as (Optional[str], optional): Show a progress bar
+                with this message while testing. Defaults to 'test classifier'.
+
+        Returns:
+            ClassifierEvaluation: The predictions and accuracies.
+
+        """
+        predictions = []
+        corrects: Optional[torch.Tensor] = None
+        totals: Optional[torch.Tensor] = None
+        for batch, logits in self._classify(
+                dataset,
+                device=device,
+                display_progress_as=display_progress_as,
+                **kwargs):
+            if corrects is None or totals is None:
+                corrects = logits.new_zeros(logits.shape[-1], dtype=torch.long)
+                totals = torch.zeros_like(corrects)
+
+            batch_predictions = logits.argmax(dim=-1)
+            targets = batch[target_index].to(logits.device, non_blocking=True)
+            corrects.scatter_add_(0, targets,
+                                  batch_predictions.eq(targets).long())
+            totals.scatter_add_(0, targets, torch.ones_like(targets))
+            predictions.append(batch_predictions)
+        assert corrects is not None and totals is not None, 'empty dataset?'
+
+        correct, total = corrects.tolist(), totals.tolist()
+        return ClassifierEvaluation(
+            predictions=torch.cat(predictions),
+            accuracy=sum(correct) / sum(total),
+            accuracies={
+                target: correct[target] / total[target]
+                for target in range(len(total))
+                if total[target]
+            },
+        )
+
+    def _classify(
+        self,
+        dataset: Union[data.Dataset, data.DataLoader],
+        image_index: int = 0,
+        batch_size: int = 128,
+        num_workers: int = 0,
+        ablate: Optional[Sequence[Unit]] = None,
+        device: Optional[Device] = None,
+        display_progress_as: Optional[str] = 'classify images',
+        compile_forward: bool = False,
+        amp: bool = False,
+    ) -> Iterator[Tuple[Any, torch.Tensor]]:
+        """Yield each batch in the dataset along with the model's logits.
+
+        See `ImageClassifier.predict` for argument docs.
+        """
+        if compile_forward and not hasattr(torch, 'compile'):
+            raise ValueError('compile_forward requires torch>=2.0')
         if device is not None:
             self.to(device)
 
-        # Prepare data loader.
-        loader = data.DataLoader(dataset,
-                                 num_workers=num_workers,
-                                 batch_size=batch_size)
+        # Prepare data loader, unless we were given one.
+        if isinstance(dataset, data.DataLoader):
+            loader = dataset
+        else:
+            pin_memory = device is not None and \
+                torch.device(device).type == 'cuda'
+            loader = data.DataLoader(dataset,
+                                     num_workers=num_workers,
+                                     batch_size=batch_size,
+                                     pin_memory=pin_memory)
         if display_progress_as is not None:
             loader = tqdm(loader, desc=display_progress_as)
 
         # Compute predictions.
-        predictions = []
         with ablated(self.model, ablate or []) as model:
+            forward: Callable[..., torch.Tensor] = model
+            if compile_forward:
+                forward = torch.compile(model,
+                                        mode='reduce-overhead',
+                                        dynamic=False)
             for batch in loader:
-                images = batch[image_index].to(device)
-                with torch.no_grad():
-                    predictions.append(model(images).argmax(dim=-1))
-
-        return torch.cat(predictions)
+                images = batch[image_index].to(device, non_blocking=True)
+                with torch.inference_mode(), env.autocast(images.device,
+                                                          enabled=amp):
+                    logits = forward(images)
+                yield batch, logits
 
     def accuracy(
         self,
@@ -275,6 +430,7 @@ class ImageClassifier(nn.Module):
         target_index: int = 1,
         device: Optional[Device] = None,
         display_progress_as: Optional[str] = 'test classifer',
+        targets: Optional[torch.Tensor] = None,
         **kwargs: Any,
     ) -> float:
         """Compute accuracy of this model on the given dataset.
@@ -292,6 +448,9 @@ class ImageClassifier(nn.Module):
                 tensors to this device. Defaults to None.
             display_progress_as (Optional[str], optional): Show a progress bar
                 with this message while testing. Defaults to 'test classifier'.
+            targets (Optional[torch.Tensor], optional): Precomputed target
+                labels, e.g. from `ImageClassifier.targets`. By default, read
+                from dataset.
 
         Returns:
             float: Accuracy on the dataset.
@@ -302,14 +461,12 @@ class ImageClassifier(nn.Module):
                                        device=device,
                                        display_progress_as=display_progress_as,
                                        **kwargs)
-        size = len(cast(Sized, dataset))
-        targets = torch.tensor(
-            [dataset[index][target_index] for index in range(size)],
-            dtype=torch.long,
-            device=device,
-        )
+        if targets is None:
+            targets = self.targets(dataset,
+                                   target_index=target_index,
+                                   device=device)
         correct = predictions.eq(targets).sum().item()
-        return correct / size
+        return correct / len(targets)
 
     def accuracies(
         self,
@@ -318,6 +475,7 @@ class ImageClassifier(nn.Module):
         target_index: int = 1,
         device: Optional[Device] = None,
         display_progress_as: Optional[str] = 'test classifer (class-wise)',
+        targets: Optional[torch.Tensor] = None,
         **kwargs: Any,
     ) -> Mapping[int, float]:
         """Compute class-by-class accuracy of this model on the given dataset.
@@ -336,6 +494,9 @@ class ImageClassifier(nn.Module):
             display_progress_as (Optional[str], optional): Show a progress bar
                 with this message while testing. Defaults to
                 'test classifier (class-wise)'.
+            targets (Optional[torch.Tensor], optional): Precomputed target
+                labels, e.g. from `ImageClassifier.targets`. By default, read
+                from dataset.
 
         Returns:
             Mapping[int, float]: Class-by-class accuracy on this dataset.
@@ -346,22 +507,49 @@ class ImageClassifier(nn.Module):
                                        device=device,
                                        display_progress_as=display_progress_as,
                                        **kwargs)
+        if targets is None:
+            targets = self.targets(dataset,
+                                   target_index=target_index,
+                                   device=device)
 
-        size = len(cast(Sized, dataset))
-        targets = torch.tensor(
-            [dataset[index][target_index] for index in range(size)],
-            dtype=torch.long,
-            device=device,
-        )
-
-        correct: Dict[int, int] = collections.defaultdict(int)
-        total: Dict[int, int] = collections.defaultdict(int)
-        for prediction, target in zip(predictions.tolist(), targets.tolist()):
-            correct[target] += prediction == target
-            total[target] += 1
-        assert correct.keys() == total.keys()
+        totals = torch.bincount(targets)
+        corrects = torch.bincount(targets[predictions.eq(targets)],
+                                  minlength=len(totals))
 
+        correct, total = corrects.tolist(), totals.tolist()
         return {
             target: correct[target] / total[target]
-            for target in correct.keys()
+            for target in range(len(total))
+            if total[target]
         }
+
+    def targets(self,
+                dataset: data.Dataset,
+                target_index: int = 1,
+                device: Optional[Device] = None) -> torch.Tensor:
+        """Read the target label of every sample in the dataset.
+
+        Computing this once and passing it to `accuracy` and `accuracies`
+        saves them from reading every sample in the dataset just to get
+        its label.
+
+        Args:
+            dataset (data.Dataset): The dataset.
+            target_index (int, optional): Index of target labels in dataset.
+                Defaults to 1 to be compatible with
+                `torchvision.datasets.ImageFolder`.
+            device (Optional[Device], optional): Send the labels to this
+                device. Defaults to None.
+
+        Returns:
+            torch.Tensor: Long tensor of shape (len(dataset),) containing
+                the target labels.
+
+        """
+        if isinstance(dataset, training.PreloadedImageFolder) and \
+                target_index in (1, -1):
+            labels = dataset.cached_labels
+        else:
+            size = len(cast(Sized, dataset))
+            labels = [dataset[index][target_index] for index in range(size)]
+        return torch.tensor(labels, dtype=torch.long, device=device)
@@ -1,8 +1,12 @@
-"""Utilities for reading relevant environment variables."""
+"""Utilities for reading and configuring the runtime environment."""
+import contextlib
 import os
 import pathlib
+from typing import Iterator, Optional
 
-from src.utils.typing import PathLike
+from src.utils.typing import Device, PathLike
+
+import torch
 
 ENV_DATA_DIR = 'MILAN_DATA_DIR'
 ENV_MODELS_DIR = 'MILAN_MODELS_DIR'
@@ -90,3 +94,101 @@ def results_dir(default: PathLike = DEFAULT_RESULTS_DIR) -> pathlib.Path:
 
     """
     return read_path(ENV_RESULTS_DIR, default)
+
+
+@contextlib.contextmanager
+def cpu_threads(num_workers: int = 0,
+                device: Optional[Device] = None) -> Iterator[int]:
+    """Limit torch's intra-op threads so they do not contend with workers.
+
+    PyTorch defaults to one intra-op thread per core. When the main process
+    computes on the CPU while `num_workers` data loader workers are busy
+    preparing batches, the two oversubscribe the machine and throughput falls
+    off a cliff. Within this context, the main process only gets the cores not
+    claimed by workers. The previous thread count is restored on exit.
+
+    Args:
+        num_workers (int, optional): Number of data loader workers that will
+            run alongside the main process. Defaults to 0.
+        device (Optional[Device], optional): Device the main process computes
+            on. If this is not a CPU device, threads are left alone.
+            Defaults to None, meaning the CPU.
+
+    Yields:
+        int: The number of intra-op threads in use.
+
+    """
+    previous = torch.get_num_threads()
+    if device is not None and torch.device(device).type != 'cpu':
+        yield previous
+        return
+
+    threads = max(1, (os.cpu_count() or 1) - num_workers)
+    threads = min(threads, previous)
+    torch.set_num_threads(threads)
+    try:
+        yield threads
+    finally:
+        torch.set_num_threads(previous)
+
+
+@contextlib.contextmanager
+def cudnn_benchmark(device: Optional[Device] = None) -> Iterator[bool]:
+    """Let cuDNN benchmark and cache the fastest conv algorithm per shape.
+
+    This pays off when the same input shapes are run many times, e.g., when
+    featurizing a whole dataset in fixed-size batches. The previous setting is
+    restored on exit.
+
+    Args:
+        device (Optional[Device], optional): Device the main process computes
+            on. If this is not a CUDA device, the setting is left alone.
+            Defaults to None, meaning the CPU.
+
+    Yields:
+        bool: Whether benchmarking is enabled.
+
+    """
+    previous = torch.backends.cudnn.benchmark
+    if device is None or torch.device(device).type != 'cuda':
+        yield previous
+        return
+
+    torch.backends.cudnn.benchmark = True
+    try:
+        yield True
+    finally:
+        torch.backends.cudnn.benchmark = previous
+
+
+@contextlib.contextmanager
+def autocast(device: Optional[Device] = None,
+             enabled: bool = False) -> Iterator[bool]:
+    """Run ops under mixed precision autocast, if enabled.
+
+    Autocast runs in float16 on CUDA and in bfloat16 everywhere else. When not
+    enabled, this does nothing at all, so it works even on torch versions that
+    predate `torch.autocast`.
+
+    Args:
+        device (Optional[Device], optional): Device the ops run on.
+            Defaults to None, meaning the CPU.
+        enabled (bool, optional): Whether to autocast. Defaults to False.
+
+    Raises:
+        ValueError: If `enabled` is set but torch cannot autocast.
+
+    Yields:
+        bool: Whether autocast is enabled.
+
+    """
+    if not enabled:
+        yield False
+        return
+    if not hasattr(torch, 'autocast'):
+        raise ValueError('autocast requires torch>=1.10')
+
+    device_type = 'cpu' if device is None else torch.device(device).type
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    with torch.autocast(device_type, dtype=dtype):
+        yield True
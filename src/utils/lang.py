@@ -2,13 +2,17 @@
 import collections
 import dataclasses
 import functools
-from typing import Any, Mapping, Optional, Sequence, Union, cast, overload
+from typing import (Any, Callable, Dict, Mapping, Optional, Sequence, Union,
+                    cast, overload)
 
 from src.utils import serialize
 from src.utils.typing import StrIterable, StrSequence, StrSet
 
 import spacy
 from spacy.lang import en
+from spacy.tokens import Doc
+
+TOKENIZER_CACHE_SIZE = 8192
 
 
 @dataclasses.dataclass(frozen=True)
@@ -52,23 +56,62 @@ class Tokenizer(serialize.Serializable):
         texts: Union[str, StrSequence],
     ) -> Union[StrSequence, Sequence[StrSequence]]:
         """Implement both overloads."""
-        tokenized = []
-        for doc in self.nlp.pipe([texts] if isinstance(texts, str) else texts):
-            tokens = []
-            for token in doc:
-                if self.ignore_stop and token.is_stop:
-                    continue
-                if self.ignore_punct and token.is_punct:
-                    continue
-                text = token.lemma_ if self.lemmatize else token.text
-                text = text.lower() if self.lowercase else text
-                if text.strip():
-                    tokens.append(text)
-            tokenized.append(tuple(tokens))
-
+        # The same single texts tend to be tokenized over and over, so cache
+        # them. Batches go straight through `nlp.pipe` instead, which already
+        # amortizes spacy's overhead across the batch.
         if isinstance(texts, str):
-            return tokenized[0]
-        return tuple(tokenized)
+            return self._tokenize(texts)
+        return tuple(self._tokens(doc) for doc in self.nlp.pipe(texts))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Drop the cache when pickling, since it cannot be pickled."""
+        state = dict(vars(self))
+        state.pop('_tokenize', None)
+        return state
+
+    @functools.cached_property
+    def _tokenize(self) -> Callable[[str], StrSequence]:
+        """Return a function that tokenizes single texts, with an LRU cache.
+
+        The cache lives on the tokenizer, so it is freed along with it (and
+        its spacy instance) rather than held on to by a global cache. It keeps
+        at most `TOKENIZER_CACHE_SIZE` texts.
+        """
+
+        @functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)
+        def tokenize(text: str) -> StrSequence:
+            return self._tokens(self.nlp(text))
+
+        return tokenize
+
+    def _tokens(self, doc: Doc) -> StrSequence:
+        """Filter and normalize the tokens of a parsed text.
+
+        Args:
+            doc (Doc): The parsed text.
+
+        Returns:
+            StrSequence: Tokenized text.
+
+        """
+        tokens = []
+        for token in doc:
+            if self.ignore_stop and token.is_stop:
+                continue
+            if self.ignore_punct and token.is_punct:
+                continue
+            text = token.lemma_ if self.lemmatize else token.text
+            text = text.lower() if self.lowercase else text
+            if text.strip():
+                tokens.append(text)
+        return tuple(tokens)
+
+    def properties(self) -> serialize.Properties:
+        """Override `Serializable.properties`."""
+        return {
+            field.name: getattr(self, field.name)
+            for field in dataclasses.fields(self)
+        }
 
 
 def tokenizer(nlp: Optional[en.English] = None,
@@ -80,16 +123,25 @@ def tokenizer(nlp: Optional[en.English] = None,
 
     Args:
         nlp (Optional[en.English], optional): Spacy instance to use.
-            Defaults to a stripped version of en_core_web_sm if not set.
+            Defaults to a stripped version of en_core_web_sm if not set,
+            or to a blank English pipeline if not lemmatizing, since
+            tokens, stop words, and punctuation do not need any trained
+            components.
         lemmatize (bool, optional): Whether to lemmatize tokens.
             Defaults to True.
 
     """
     if nlp is None:
-        nlp = cast(en.English, spacy.load('en_core_web_sm'))
+        nlp = _load_nlp() if lemmatize else cast(en.English, spacy.blank('en'))
     return Tokenizer(nlp, lemmatize=lemmatize, **kwargs)
 
 
+@functools.lru_cache(maxsize=1)
+def _load_nlp() -> en.English:
+    """Load en_core_web_sm once and share it between default tokenizers."""
+    return cast(en.English, spacy.load('en_core_web_sm'))
+
+
 @dataclasses.dataclass(frozen=True)
 class Vocab(serialize.Serializable):
     """A data class that stores tokens and a corresponding tokenizer."""
@@ -1,9 +1,11 @@
 """Utilities for training models."""
+import math
 import pathlib
-from typing import Any, Sequence, Sized, Tuple, cast
+from typing import Any, Iterator, List, Sequence, Sized, Tuple, cast
 
 from src.utils.typing import PathLike
 
+import torch
 from torch.utils import data
 from torchvision import datasets
 from tqdm import tqdm
@@ -110,6 +112,73 @@ def fixed_split(dataset: data.Dataset,
     return data.Subset(dataset, others), data.Subset(dataset, indices)
 
 
+class BucketSampler(data.Sampler):
+    """Batches together samples of similar length to minimize padding.
+
+    Samples are shuffled, divided into buckets of several batches each, and
+    sorted by length within each bucket before being split into batches. The
+    order of the batches is then shuffled again. Batches still vary from
+    epoch to epoch, but each one pads far less than a random batch would.
+    Use as the `batch_sampler` of a `torch.utils.data.DataLoader`.
+    """
+
+    def __init__(self,
+                 lengths: Sequence[int],
+                 batch_size: int = 128,
+                 shuffle: bool = True,
+                 batches_per_bucket: int = 50):
+        """Initialize the sampler.
+
+        Args:
+            lengths (Sequence[int]): Length of each sample in the dataset.
+            batch_size (int, optional): Number of samples per batch.
+                Defaults to 128.
+            shuffle (bool, optional): Shuffle samples before bucketing and
+                shuffle batches afterward. If False, the full dataset is
+                sorted by length. Defaults to True.
+            batches_per_bucket (int, optional): Number of batches in each
+                bucket. Larger buckets mean less padding but less random
+                batches. Defaults to 50.
+
+        """
+        if batch_size < 1:
+            raise ValueError(f'batch_size must be >= 1, got {batch_size}')
+        if batches_per_bucket < 1:
+            raise ValueError('batches_per_bucket must be >= 1, '
+                             f'got {batches_per_bucket}')
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batches_per_bucket = batches_per_bucket
+
+    def __iter__(self) -> Iterator[List[int]]:
+        """Yield batches of sample indices."""
+        size = len(self.lengths)
+        if self.shuffle:
+            indices = torch.randperm(size).tolist()
+            bucket_size = self.batch_size * self.batches_per_bucket
+        else:
+            indices = list(range(size))
+            bucket_size = max(size, 1)
+
+        batches = []
+        for start in range(0, size, bucket_size):
+            bucket = sorted(indices[start:start + bucket_size],
+                            key=self.lengths.__getitem__)
+            for offset in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[offset:offset + self.batch_size])
+
+        if self.shuffle:
+            order = torch.randperm(len(batches)).tolist()
+            batches = [batches[index] for index in order]
+
+        return iter(batches)
+
+    def __len__(self) -> int:
+        """Return the number of batches."""
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
 # TODO(evandez): This really isn't a very elegant solution to the threading
 # problem of ImageFolder, as it loads the images in serial and this is very
 # slow for any dataset worth its muster. Better to figure out why threading
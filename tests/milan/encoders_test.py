@@ -16,10 +16,62 @@ def test_encoder_map(encoder, top_images_dataset, device):
                          display_progress_as=None,
                          device=device)
     assert len(actual) == len(top_images_dataset)
-    for (features,) in actual:
-        assert features.shape == (root.N_TOP_IMAGES_PER_UNIT,
-                                  *local.FEATURE_SHAPE)
-        assert features.eq(0).all()
+
+    features, = actual.tensors
+    assert features.shape == (len(top_images_dataset),
+                              root.N_TOP_IMAGES_PER_UNIT, *local.FEATURE_SHAPE)
+    assert features.eq(0).all()
+
+
+@pytest.mark.parametrize('device', (None, 'cpu'))
+def test_encoder_map_cuda_graphs_without_cuda(encoder, top_images_dataset,
+                                              device):
+    """Test Encoder.map dies when cuda_graphs is set but device is not cuda."""
+    with pytest.raises(ValueError, match='.*cuda_graphs.*'):
+        encoder.map(top_images_dataset,
+                    image_index=-2,
+                    mask_index=-1,
+                    display_progress_as=None,
+                    cuda_graphs=True,
+                    device=device)
+
+
+def test_encoder_map_cuda_graphs_unsupported(encoder, top_images_dataset,
+                                             monkeypatch):
+    """Test Encoder.map dies when cuda_graphs is set but torch is too old."""
+    monkeypatch.delattr(torch.cuda, 'graph', raising=False)
+    with pytest.raises(ValueError, match='.*torch>=1.10.*'):
+        encoder.map(top_images_dataset,
+                    image_index=-2,
+                    mask_index=-1,
+                    display_progress_as=None,
+                    cuda_graphs=True,
+                    device='cuda')
+
+
+def test_encoder_map_compile_forward_unsupported(encoder, top_images_dataset,
+                                                 monkeypatch):
+    """Test Encoder.map dies when compile_forward is set but torch is old."""
+    monkeypatch.delattr(torch, 'compile', raising=False)
+    with pytest.raises(ValueError, match='.*torch>=2.0.*'):
+        encoder.map(top_images_dataset,
+                    image_index=-2,
+                    mask_index=-1,
+                    display_progress_as=None,
+                    compile_forward=True)
+
+
+def test_encoder_map_cuda_graphs_and_compile_forward(encoder,
+                                                     top_images_dataset):
+    """Test Encoder.map dies when cuda_graphs and compile_forward are set."""
+    with pytest.raises(ValueError, match='.*compile_forward.*'):
+        encoder.map(top_images_dataset,
+                    image_index=-2,
+                    mask_index=-1,
+                    display_progress_as=None,
+                    cuda_graphs=True,
+                    compile_forward=True,
+                    device='cuda')
 
 
 def test_pyramid_conv_encoder_init_bad_config():
@@ -29,49 +81,122 @@ def test_pyramid_conv_encoder_init_bad_config():
         encoders.PyramidConvEncoder(config=bad)
 
 
-BATCH_SIZE = 10
-IMAGE_SIZE = 224
+# Keep inputs small: the encoder pools each level of the pyramid, so its
+# output shape does not depend on image size.
+BATCH_SIZE = 4
+IMAGE_SIZE = 64
 IMAGE_SHAPE = (3, IMAGE_SIZE, IMAGE_SIZE)
 MASK_SHAPE = (1, IMAGE_SIZE, IMAGE_SIZE)
 
 
-@pytest.fixture
+@pytest.fixture(scope='module', params=('resnet18', 'alexnet'))
+def pyramid_conv_encoder(request):
+    """Return a PyramidConvEncoder for each config, built once per module."""
+    return encoders.PyramidConvEncoder(config=request.param, pretrained=False)
+
+
+@pytest.fixture(scope='module')
 def images():
-    """Return fake images for testing."""
-    return torch.rand(BATCH_SIZE, *IMAGE_SHAPE)
+    """Return fake images for testing. Tests must not modify them."""
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand(BATCH_SIZE, *IMAGE_SHAPE, generator=generator)
 
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def masks():
-    """Return fake masks for testing."""
-    return torch.randint(2, size=(BATCH_SIZE, *MASK_SHAPE), dtype=torch.float)
+    """Return fake masks for testing. Tests must not modify them."""
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(2,
+                         size=(BATCH_SIZE, *MASK_SHAPE),
+                         generator=generator,
+                         dtype=torch.float)
 
 
-@pytest.mark.parametrize('config', ('resnet18', 'alexnet'))
-def test_pyramid_conv_encoder_forward(config, images, masks):
+def test_pyramid_conv_encoder_forward(pyramid_conv_encoder, images, masks):
     """Test PyramidConvEncoder.forward returns correct shape."""
-    encoder = encoders.PyramidConvEncoder(config=config, pretrained=False)
-    actual = encoder(images, masks)
-    assert actual.shape == (BATCH_SIZE, *encoder.feature_shape)
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, masks)
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
+    assert not torch.isnan(actual).any()
+
+
+def test_pyramid_conv_encoder_forward_full_size(pyramid_conv_encoder):
+    """Test PyramidConvEncoder.forward handles ImageNet-sized inputs."""
+    images = torch.rand(2, 3, 224, 224)
+    masks = torch.randint(2, size=(2, 1, 224, 224), dtype=torch.float)
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, masks)
+    assert actual.shape == (2, *pyramid_conv_encoder.feature_shape)
+    assert not torch.isnan(actual).any()
+
+
+@pytest.mark.skipif(not hasattr(torch, 'autocast'),
+                    reason='autocast requires torch>=1.10')
+def test_pyramid_conv_encoder_forward_amp(pyramid_conv_encoder, images, masks):
+    """Test PyramidConvEncoder.forward pools in float32 under autocast."""
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, masks, amp=True)
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
+    assert actual.dtype == torch.float32
     assert not torch.isnan(actual).any()
 
 
-@pytest.mark.parametrize('config', ('resnet18', 'alexnet'))
-def test_pyramid_conv_encoder_forward_invalid_mask(config, images, masks):
+def test_pyramid_conv_encoder_forward_without_autocast(pyramid_conv_encoder,
+                                                       images, masks,
+                                                       monkeypatch):
+    """Test PyramidConvEncoder.forward only needs torch.autocast for amp."""
+    monkeypatch.delattr(torch, 'autocast', raising=False)
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, masks)
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
+    with pytest.raises(ValueError, match='.*torch>=1.10.*'):
+        pyramid_conv_encoder(images, masks, amp=True)
+
+
+def test_pyramid_conv_encoder_forward_invalid_mask(pyramid_conv_encoder,
+                                                   images, masks):
     """Test PyramidConvEncoder.forward handles some invalid masks."""
-    encoder = encoders.PyramidConvEncoder(config=config, pretrained=False)
+    masks = masks.clone()
     masks[-2:] = 0
-    actual = encoder(images, masks)
-    assert actual.shape == (BATCH_SIZE, *encoder.feature_shape)
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, masks)
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
+    assert actual[-2:].eq(0).all()
+    assert not actual[:-2].eq(0).all()
+    assert not torch.isnan(actual).any()
+
+
+@pytest.mark.parametrize('invalid', (0, 2, BATCH_SIZE))
+def test_pyramid_conv_encoder_forward_skip_empty(pyramid_conv_encoder, images,
+                                                 masks, invalid):
+    """Test PyramidConvEncoder.forward skips invalid masks consistently."""
+    masks = masks.clone()
+    masks[:invalid] = 0
+    with torch.inference_mode():
+        expected = pyramid_conv_encoder(images, masks)
+        actual = pyramid_conv_encoder(images, masks, skip_empty=True)
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
+    assert actual[:invalid].eq(0).all()
+    assert actual.allclose(expected, atol=1e-6)
+
+
+def test_pyramid_conv_encoder_forward_near_zero_masks(pyramid_conv_encoder,
+                                                      images, masks):
+    """Test PyramidConvEncoder.forward zeros masks that are nearly zero."""
+    masks = masks.clone()
+    masks[-2:] *= 1e-9
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, masks)
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
     assert actual[-2:].eq(0).all()
     assert not actual[:-2].eq(0).all()
     assert not torch.isnan(actual).any()
 
 
-@pytest.mark.parametrize('config', ('resnet18', 'alexnet'))
-def test_pyramid_conv_encoder_forward_all_invalid_masks(config, images, masks):
+def test_pyramid_conv_encoder_forward_all_invalid_masks(
+        pyramid_conv_encoder, images, masks):
     """Test PyramidConvEncoder.forward handles all invalid masks."""
-    encoder = encoders.PyramidConvEncoder(config=config, pretrained=False)
-    actual = encoder(images, torch.zeros_like(masks))
-    assert actual.shape == (BATCH_SIZE, *encoder.feature_shape)
+    with torch.inference_mode():
+        actual = pyramid_conv_encoder(images, torch.zeros_like(masks))
+    assert actual.shape == (BATCH_SIZE, *pyramid_conv_encoder.feature_shape)
     assert actual.eq(0).all()
@@ -0,0 +1,86 @@
+"""Unit tests for `src.milan.lms` module."""
+from src.milan import lms
+from src.utils import lang
+
+import pytest
+import torch
+
+SEQUENCES = (
+    'a dog runs',
+    'the cat sat on the mat',
+    'birds',
+    'red and blue stripes',
+    'a red dog sat',
+)
+
+
+@pytest.fixture(scope='module')
+def indexer():
+    """Return an indexer over SEQUENCES for testing."""
+    return lang.indexer(SEQUENCES,
+                        tokenize=lang.tokenizer(lemmatize=False),
+                        start=True,
+                        stop=True,
+                        pad=True,
+                        unk=True)
+
+
+@pytest.fixture
+def lm(indexer):
+    """Return a small LanguageModel for testing."""
+    torch.manual_seed(0)
+    return lms.LanguageModel(indexer, embedding_size=8, hidden_size=16)
+
+
+@pytest.mark.parametrize('batch_size', (1, 2, len(SEQUENCES)))
+def test_language_model_logp(lm, batch_size):
+    """Test LanguageModel.logp does not depend on batching."""
+    expected = torch.cat([
+        lm.logp([sequence], display_progress_as=None) for sequence in SEQUENCES
+    ])
+    actual = lm.logp(SEQUENCES,
+                     batch_size=batch_size,
+                     display_progress_as=None)
+    assert actual.shape == (len(SEQUENCES),)
+    assert actual.lt(0).all()
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+def test_language_model_logp_empty(lm):
+    """Test LanguageModel.logp returns nothing for no sequences."""
+    actual = lm.logp([], display_progress_as=None)
+    assert actual.shape == (0,)
+
+
+def test_language_model_load_state_dict_legacy_output(lm, indexer):
+    """Test LanguageModel.load_state_dict reads old `output.0` keys."""
+    state_dict = {
+        key.replace('output.', 'output.0.'): value
+        for key, value in lm.state_dict().items()
+    }
+    assert 'output.0.weight' in state_dict
+
+    loaded = lms.LanguageModel(indexer, embedding_size=8, hidden_size=16)
+    loaded.load_state_dict(state_dict)
+    for key, value in lm.state_dict().items():
+        assert loaded.state_dict()[key].equal(value)
+
+
+@pytest.mark.parametrize('hold_out', (.4, (0, 1), (2,), [3]))
+def test_language_model_fit(lm, hold_out):
+    """Test LanguageModel.fit trains with any kind of hold out set."""
+    dataset = [(sequence,) for sequence in SEQUENCES]
+    lm.fit(dataset,
+           annotation_index=0,
+           batch_size=2,
+           max_epochs=1,
+           hold_out=hold_out,
+           display_progress_as=None)
+    assert lm.logp(SEQUENCES, display_progress_as=None).isfinite().all()
+
+
+def test_language_model_fit_compile_forward_unsupported(lm, monkeypatch):
+    """Test LanguageModel.fit dies when compile_forward needs torch>=2.0."""
+    monkeypatch.delattr(torch, 'compile', raising=False)
+    with pytest.raises(ValueError, match='.*compile_forward.*'):
+        lm.fit([], compile_forward=True, display_progress_as=None)
@@ -1,6 +1,7 @@
 """Unit tests for `src.utils.lang` module."""
 import collections
 import itertools
+import pickle
 
 from src.utils import lang
 
@@ -11,7 +12,8 @@ import spacy
 @pytest.fixture(scope='module')
 def nlp():
     """Return a single spacy instance for testing."""
-    return spacy.load('en_core_web_sm')
+    # Lemmas only need the tagger, so skip loading everything downstream.
+    return spacy.load('en_core_web_sm', exclude=('parser', 'ner'))
 
 
 def test_tokenizer():
@@ -23,6 +25,13 @@ def test_tokenizer():
     assert tokenizer.lemmatize is True
 
 
+def test_tokenizer_no_lemmatize():
+    """Test tokenizer factory uses a blank pipeline when not lemmatizing."""
+    tokenizer = lang.tokenizer(lemmatize=False)
+    assert tokenizer.nlp.pipe_names == []
+    assert tokenizer.lemmatize is False
+
+
 @pytest.mark.parametrize('lemmatize,lowercase,ignore_punct,ignore_stop',
                          itertools.product((False, True), repeat=4))
 def test_tokenizer_override(nlp, lemmatize, lowercase, ignore_punct,
@@ -43,6 +52,11 @@ def test_tokenizer_override(nlp, lemmatize, lowercase, ignore_punct,
 @pytest.mark.parametrize('kwargs,texts,expected', (
     ({}, 'the Foo bar broke.', ('foo', 'bar', 'break')),
     ({}, ('the Foo bar broke.',), (('foo', 'bar', 'break'),)),
+    (
+        {},
+        ('the Foo bar broke.', 'the Foo bar.', 'a baz!'),
+        (('foo', 'bar', 'break'), ('foo', 'bar'), ('baz',)),
+    ),
     (
         dict(lemmatize=False),
         ('the Foo bar stayed.',),
@@ -59,13 +73,40 @@ def test_tokenizer_call(nlp, kwargs, texts, expected):
     assert actual == expected
 
 
+def test_tokenizer_call_cached(nlp):
+    """Test Tokenizer.__call__ reuses results only within a tokenizer."""
+    tokenizer = lang.tokenizer(nlp=nlp)
+    text = 'the Foo bar broke.'
+    expected = tokenizer(text)
+    assert tokenizer(text) is expected
+    assert lang.tokenizer(nlp=nlp)(text) is not expected
+    assert '_tokenize' not in tokenizer.properties()
+
+
+def test_tokenizer_call_cache_bounded(monkeypatch):
+    """Test Tokenizer.__call__ keeps at most TOKENIZER_CACHE_SIZE texts."""
+    monkeypatch.setattr(lang, 'TOKENIZER_CACHE_SIZE', 2)
+    tokenizer = lang.tokenizer(lemmatize=False)
+    for text in ('foo', 'bar', 'baz', 'foo bar'):
+        tokenizer(text)
+    assert tokenizer._tokenize.cache_info().currsize == 2
+
+
+def test_tokenizer_pickle():
+    """Test Tokenizer can be pickled after it has cached texts."""
+    tokenizer = lang.tokenizer(lemmatize=False)
+    expected = tokenizer('the Foo bar.')
+    actual = pickle.loads(pickle.dumps(tokenizer))
+    assert actual('the Foo bar.') == expected
+
+
 TOKEN_0 = 'foo'
 TOKEN_1 = 'bar'
 TOKEN_2 = 'baz'
 TOKENS = (TOKEN_0, TOKEN_1, TOKEN_2)
 
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def vocab():
     """Return a Vocab for testing."""
     return lang.Vocab(TOKENS)
@@ -120,7 +161,7 @@ def test_vocab_unique(vocab):
     assert vocab.unique == frozenset(TOKENS)
 
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def tokenizer(nlp):
     """Return a Tokenizer for testing."""
     return lang.tokenizer(nlp=nlp)
@@ -148,7 +189,7 @@ def test_vocab_default_tokenizer():
     assert vocab.tokens
 
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def indexer(vocab, tokenizer):
     """Return an indexer for testing."""
     return lang.Indexer(vocab, tokenizer)
@@ -83,7 +83,7 @@ class SerializableObjectWithNLP(SerializableObject):
 @pytest.fixture(scope='module')
 def nlp():
     """Return a singleton fake NLP object for testing."""
-    return spacy.load('en_core_web_sm')
+    return spacy.load('en_core_web_sm', exclude=('parser', 'ner'))
 
 
 @pytest.fixture
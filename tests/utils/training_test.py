@@ -1,6 +1,8 @@
 """Unit tests for the `src.utils.training` module."""
 from src.utils import training
 
+import pytest
+
 PATIENCE = 5
 
 
@@ -58,3 +60,50 @@ def test_early_stopping_improved():
 
     early_stopping(-1)
     assert early_stopping.improved
+
+
+LENGTHS = (5, 1, 4, 2, 3, 1, 5, 2, 4, 3)
+BATCH_SIZE = 3
+
+
+@pytest.mark.parametrize('shuffle', (True, False))
+def test_bucket_sampler_iter(shuffle):
+    """Test BucketSampler.__iter__ yields every index once, batched."""
+    sampler = training.BucketSampler(LENGTHS,
+                                     batch_size=BATCH_SIZE,
+                                     shuffle=shuffle,
+                                     batches_per_bucket=2)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 4
+    assert all(len(batch) <= BATCH_SIZE for batch in batches)
+    assert sorted(index for batch in batches for index in batch) == list(
+        range(len(LENGTHS)))
+
+
+@pytest.mark.parametrize('shuffle', (True, False))
+def test_bucket_sampler_iter_empty(shuffle):
+    """Test BucketSampler.__iter__ yields nothing when there are no samples."""
+    sampler = training.BucketSampler([],
+                                     batch_size=BATCH_SIZE,
+                                     shuffle=shuffle)
+    assert list(sampler) == []
+    assert len(sampler) == 0
+
+
+def test_bucket_sampler_iter_no_shuffle_sorts():
+    """Test BucketSampler.__iter__ sorts by length when not shuffling."""
+    sampler = training.BucketSampler(LENGTHS,
+                                     batch_size=BATCH_SIZE,
+                                     shuffle=False)
+    actual = [LENGTHS[index] for batch in sampler for index in batch]
+    assert actual == sorted(LENGTHS)
+
+
+@pytest.mark.parametrize('kwargs', (
+    dict(batch_size=0),
+    dict(batches_per_bucket=0),
+))
+def test_bucket_sampler_init_bad_sizes(kwargs):
+    """Test BucketSampler.__init__ dies on nonpositive sizes."""
+    with pytest.raises(ValueError, match='.*must be >= 1.*'):
+        training.BucketSampler(LENGTHS, **kwargs)